@@ -14,6 +14,7 @@ from mle_estim_error import MLE_estim_error
 from scipy.stats import binned_statistic  # For calculating binned values for better visualization.
 from statsmodels.stats.moment_helpers import cov2corr
 from scipy.special import kv as kv  # Import Bessel functions of second kind
+from scipy.special import kve  # Exponentially scaled version
 from scipy.optimize import curve_fit
 from itertools import izip
 from functools import partial
@@ -344,7 +345,8 @@ class MLE_analyse(object):
         # gss = np.array([3537.4, ])  # For testing
         
         if self.all_chrom:  # Do the sum for multiple chromosomes. 
-            temp_dens = partial(all_chromosomes, gs=gss / 100.0)  
+            chrom_sum = chrom_sum_funcs.get(bl_shr_density, all_chromosomes)  # Faster sum if known to be allowed
+            temp_dens = partial(chrom_sum, gs=gss / 100.0)  
             bl_shr_density = partial(temp_dens, bl_density=bl_shr_density)  # Fix function
         
         
@@ -787,10 +789,11 @@ def bd_basis(l, r, D, sigma, b):
     '''Bessel decay for power growth model and G=1
     Central Ingredient for further calculations. Return density per cM'''
     C = 2 ** (-3 - 3 * b / 2.0) / (np.pi * sigma ** 2 * D)  # The constant in front
+    z = r / sigma
+    x = np.sqrt(2.0 * l) * z  # Argument of the Bessel function
 
-    b_l = C * (r / (np.sqrt(l) * sigma)) ** (2 + b) * kv(2 + b,
-    np.sqrt(2.0 * l) * r / sigma)
-    return b_l / 100.0  # Factor for density in centi Morgan
+    b_l = (C / 100.0 * z ** (2 + b)) * np.sqrt(l) ** (-2 - b) * kve(2 + b, x) * np.exp(-x)  # Factor 100 for density in centi Morgan
+    return b_l
 
 def bessel_decay_interval(r, C, sigma, interval, mu=0):
     '''Gives Bessel-Decay in a given interval If r vector returns vector'''
@@ -850,6 +853,13 @@ def all_chromosomes(l, r, params, bl_density, gs):
     # Problem np.sum initially summed over r; but only need to sum over gi! SOLVED
     return(res)
 
+def all_chromosomes_affine(l, r, params, bl_density, gs):
+    '''Same as all_chromosomes for densities which are affine in the chromosome length g.
+    Then the sum over chromosomes is their number times the density at the mean length;
+    so only one evaluation is needed instead of one per chromosome.
+    '''
+    return 4.0 * len(gs) * bl_density(l, r, params, np.mean(gs))
+
 # Original powergrowth density
 # def powergrowth_density(l, r, params, g):
 #     '''Gives uniform density per cM(!) If l vector return vector'''
@@ -915,6 +925,9 @@ def powergrowth_density_dd(l, r, params, g):
     C = g / (4 * np.pi * sigma ** 2 * D)  # The constant in front
     return powergrowth_density(l, r, [C , sigma, b]) + uniform_density(l, r, [T * C, sigma])
 
+# Function to sum block sharing densities over chromosomes. Densities affine in g (edge effects) can use the fast one:
+chrom_sum_funcs = {uniform_density: all_chromosomes_affine, dd_density: all_chromosomes_affine,
+                   powergrowth_density: all_chromosomes_affine}
 
 # def from_C_to_D_e(C, sigma):
 #   '''Calculates the actual density from C and sigma'''
@@ -4,9 +4,13 @@ Created on Feb 18, 2016
 @Harald: Contains class for MLE estimaton with
 estimated error. Everything here is measured in cM
 Most quantities are for probabilities per pair
+The densities are called with r as column and l as row vector. Prefactors
+only depending on r or only on l are computed on that column or row
+before they are broadcast to the (r, l)-grid
 '''
 from statsmodels.base.model import GenericLikelihoodModel
-from scipy.special import kv as kv  # Import Bessel functions of second kind
+from scipy.optimize import minimize
+from scipy.special import kve  # Import exponentially scaled Bessel functions of second kind
 from bisect import bisect_left, bisect_right
 import matplotlib.pyplot as plt
 import numpy as np
@@ -28,85 +32,121 @@ class MLE_estim_error(GenericLikelihoodModel):
     fp_rate = []  # Array for false positives
     theoretical_shr = []  # Array for theoretical expected sharing per bin
     trans_mat = np.zeros((2, 2))  # Transition matrix for theor. to expected block-sharing
+    trans_mat_active = np.zeros((2, 2))  # Rows of the transition matrix for the bins of interest
     full_shr_pr = []  # Array for the full bin sharing 
       
     density_fun = 0  # function used to calculate the block sharing density; is required to be per cM!!
     start_params = []  # List of parameters for the starting array
     error_model = True  # Parameter whether to use error model
+    verbose = False  # Whether to print parameters and log likelihood at every evaluation
+    fast_fit = False  # Whether to minimize the total negative log likelihood directly with scipy
     estimates = []  # The last parameter which has been fit
     
-    def __init__(self, bl_dens_fun, start_params, pw_dist, pw_IBD, pw_nr, error_model=True, **kwds):
+    def __init__(self, bl_dens_fun, start_params, pw_dist, pw_IBD, pw_nr, error_model=True, verbose=False, fast_fit=False, **kwds):
         '''Takes the function; start parameters and three important lists as input:
         List of pw. distances, list of pw. nr and list of pw. IBD-Lists (in cM)'''
-        exog = np.column_stack((pw_dist, pw_nr))  # Stack the exogenous variables together
+        self._r = np.ascontiguousarray(pw_dist, dtype='float')  # Keep pw. distances and pw. nr as separate arrays
+        self._pw_nr = np.ascontiguousarray(pw_nr, dtype='float')
+        exog = np.empty((len(self._r), 2), dtype='float')  # Stack the exogenous variables together (C-order)
+        exog[:, 0], exog[:, 1] = self._r, self._pw_nr
         endog = pw_IBD
         super(MLE_estim_error, self).__init__(endog, exog, **kwds)  # Create the full object.
         self.create_bins()  # Create the Mid Bin vector
+        block_bin_idx = [self.get_block_indices(l) for l in pw_IBD]  # Bin indices of all shared blocks PER PAIR
+        self._block_pair = np.repeat(np.arange(len(block_bin_idx)), [len(i) for i in block_bin_idx])  # Pair of every block
+        # Flat index of every block into the (pairs x bins of interest) sharing matrix:
+        self._block_idx = self._block_pair * (self.max_ind - self.min_ind) + np.concatenate(block_bin_idx).astype('int')
         self.fp_rate = fp_rate(self.mid_bins) * self.bin_width  # Calculate the false positives per bin
+        self._full_shr_pr_buf = np.empty(0)  # Array the full bin sharing is written into
+        self._ninf_vec = -np.ones(len(self._r)) * (np.inf)  # Log likelihoods for invalid parameters
         self.density_fun = bl_dens_fun  # Set the block density function 
         self.start_params = start_params 
         self.error_model = error_model  # Whether to use error model
+        self.verbose = verbose  # Whether to print at every evaluation
+        self.fast_fit = fast_fit  # Whether to use scipy.optimize.minimize for the fit
         if self.error_model == True:  # In case required:  
             self.calculate_trans_mat()  # Calculate the Transformation matrix
         
     def loglikeobs(self, params):
         '''Return vector of log likelihoods for every observation. (here pairs of pops)'''
-        for i in range(len(params)):
-            print("Parameter %.0f : %.8f" % (i, params[i]))
+        if self.verbose:
+            for i in range(len(params)):
+                print("Parameter %.0f : %.8f" % (i, params[i]))
         C = params[0]  # Absolute Parameter
         sigma = params[1]  # Dispersal parameter
 
         
         if C <= 0 or sigma <= 0:  # If Parameters do not make sense return infinitely negative likelihood
-            return -np.ones(len(self.endog)) * (np.inf)
+            return self._ninf_vec  # Shared between calls; callers must not change it (statsmodels only sums it)
         
-        ll = [self.pairwise_ll(self.endog[i], self.exog[i, :], params) for i in range(len(self.endog))]
-        print("Total log likelihood: %.4f" % np.sum(ll))
-        return np.array(ll).astype('float')  # Return negative log likelihood
+        r, pw_nr = self._r, self._pw_nr  # Distances and nr of pairs for all observations
+        self.calculate_thr_shr(r[:, None], params)  # Calculate theoretical sharing for ALL pairs at once
+        self.calculate_full_bin_prob(interest_only=True)  # Calculate total sharing for all pairs (one row per pair)
+        shr_pr = self.full_shr_pr
+        
+        log_pr_no_shr = -np.sum(shr_pr, axis=1) * pw_nr  # The negative sum of all total sharing probabilities
+        log_pr_shr = np.log(shr_pr.take(self._block_idx))  # Log probabilities of all shared blocks
+        ll = np.bincount(self._block_pair, weights=log_pr_shr, minlength=len(pw_nr)) + log_pr_no_shr  # Sum up per pair
+        if self.verbose:
+            print("Total log likelihood: %.4f" % np.sum(ll))
+        return ll  # Return negative log likelihood
 
     def fit(self, start_params=None, maxiter=10000, maxfun=5000, **kwds):
         # we have one additional parameter and we need to add it for summary
         if start_params == None:
             start_params = self.start_params  # Set the starting parameters for the fit
+        if self.fast_fit:  # Find the optimum directly; then let statsmodels only build the results there
+            if 'method' in kwds:
+                raise ValueError("fast_fit always uses L-BFGS-B; do not pass method")
+            settings = {'optimizer': 'lbfgs', 'start_params': start_params, 'maxiter': maxiter, 'maxfun': maxfun}
+            scale = np.abs(np.asarray(start_params, dtype='float'))  # Fit in units of start parameters; C and sigma differ by orders
+            scale[scale == 0] = 1.0
+            bounds = [(1e-12 / scale[0], None), (1e-12 / scale[1], None)] + [(None, None)] * (len(scale) - 2)  # C, sigma > 0
+            opt = minimize(lambda x: self.neg_loglike(x * scale), np.ones(len(scale)), method='L-BFGS-B',
+                           bounds=bounds, options={'maxiter': maxiter, 'maxfun': maxfun})
+            start_params, maxiter = opt.x * scale, 0
+            kwds['method'] = 'bfgs'  # Does not move away from start_params with maxiter=0
+            kwds['warn_convergence'] = False
         fit = super(MLE_estim_error, self).fit(start_params=start_params,
                                      maxiter=maxiter, maxfun=maxfun,
                                      **kwds)
+        if self.fast_fit:  # Report the actual optimization instead of the zero step BFGS run
+            fit.mle_settings.update(settings)
+            fit.mle_retvals = {'fopt': opt.fun, 'gopt': opt.jac / scale,  # Total neg. log likelihood and its gradient
+                               'fcalls': opt.nfev, 'iterations': opt.nit, 'warnflag': opt.status,
+                               'converged': opt.success, 'message': opt.message, 'optimize_result': opt}
         self.estimates = fit.params
         return fit
     
-    def pairwise_ll(self, l, exog, params):
-        '''Log likelihood function for every raw of data (sharing between countries).
-        Return log likelihood.'''
-        r, pw_nr = exog[0], exog[1]  # Distance between populations
+    def neg_loglike(self, params):
+        '''Return the negative total log likelihood of all observations (to minimize)'''
+        return -np.sum(self.loglikeobs(params))
+    
+    def get_block_indices(self, l):
+        '''Return the indices of the bins of interest in which the blocks of l fall.
+        Blocks outside of the bins of interest are cut out.'''
         l = np.array(l)  # Make l an Numpy vector for better handling
-        
-        bins = self.mid_bins[self.min_ind:self.max_ind + 1] - 0.5 * self.bin_width  # Rel. bin edges
+        bins = self._rel_bin_edges  # Rel. bin edges
         l = l[(l >= bins[0]) * (l <= bins[-1])]  # Cut out only blocks of interest
-        
-        self.calculate_thr_shr(r, params)  # Calculate theoretical sharing PER PAIR
-        self.calculate_full_bin_prob()  # Calculate total sharing PER PAIR /TM Matrix and FP-rate dont need update
-        shr_pr = self.full_shr_pr[self.min_ind:self.max_ind]
-        
-        log_pr_no_shr = -np.sum(shr_pr) * pw_nr  # The negative sum of all total sharing probabilities
-        if len(l) > 0:
-            indices = np.array([(bisect_left(bins, x) - 1) for x in l])  # Get indices of all shared blocks
-            l1 = np.sum(np.log(shr_pr[indices]))
-        else: l1 = 0
-        ll = l1 + log_pr_no_shr
-        return(ll)    
+        indices = np.searchsorted(bins, l, side='right') - 1  # Get indices of all shared blocks
+        return np.minimum(indices, len(bins) - 2)  # Block on upper edge goes into last bin
     
     def create_bins(self):
         '''Creates the bins according to parameters'''
-        bins = np.arange(self.min_b, self.max_b, self.bin_width)  # Create the actual bins
+        n = int(round((self.max_b - self.min_b) / self.bin_width))  # Nr. of bins; exact despite float bin width
+        bins = np.linspace(self.min_b, self.min_b + n * self.bin_width, n, endpoint=False)  # Create the actual bins
         
         self.min_ind = bisect_left(bins, self.min_len)  # Find the indices of the relevant points
         self.max_ind = bisect_left(bins, self.max_len)
         self.mid_bins = bins + 0.5 * self.bin_width
+        self._rel_bin_edges = bins[self.min_ind:self.max_ind + 1]  # Edges of the bins of interest
+        self._shr_slice = slice(self.min_ind, self.max_ind)  # Bins of interest
         k = len(self.mid_bins)
         self.trans_mat = np.zeros((k, k)).astype(float)  # Create empty transition matrix
         
     def calculate_thr_shr(self, r, params):
-        '''Calculates the expected Bessel-Decay per bin''' 
+        '''Calculates the expected Bessel-Decay per bin.
+        If r is column vector return matrix (one row per r)''' 
         # bd = bessel_decay_dens(self.mid_bins, r, C, sigma, mu)
         bd = self.block_shr_density(self.mid_bins, r, params)
         self.theoretical_shr = bd * self.bin_width  # Normalize for bin width (in cm)
@@ -114,32 +154,39 @@ class MLE_estim_error(GenericLikelihoodModel):
     def calculate_trans_mat(self):
         '''Calculate the transition matrix from true estimated to
         observed values for block sharing.'''
-        k = len(self.trans_mat)
-        for i in range(k):  # Iterate over all starting values
-            x = self.mid_bins[i]
-            pr_detect = (1 - censor_prob((x)))  # Probability of detecting block
-            for j in range(0, i):
-                y = self.mid_bins[j]
-                # Down probability conditional on bigger than cut off:
-                trans_pr = prob_down(x) * down_rate(x) * np.exp(-down_rate(x) * (x - y)) / (1 - np.exp(-down_rate(x) * (x - 1)))
-                self.trans_mat[j, i] = pr_detect * trans_pr * self.bin_width 
-                              
-            for j in range(i + 1, k):
-                y = self.mid_bins[j]
-                trans_pr = (1 - prob_down(x)) * up_rate(x) * np.exp(-up_rate(x) * (y - max(x, 1)))     
-                self.trans_mat[j, i] = pr_detect * trans_pr * self.bin_width
-            
-            y = x  # Now do the i,i case
-            trans_pr_d = prob_down(x) * down_rate(x) * np.exp(-down_rate(x) * (x - y)) / (1 - np.exp(-down_rate(x) * (x - 1)))
-            # trans_pr_u = (1 - prob_down(x)) * up_rate(x) * np.exp(-up_rate(x) * (y - max(x, 1)))
-            trans_pr_u = (1 - prob_down(x)) * up_rate(x) * np.exp(-up_rate(x) * (y - x))
-            self.trans_mat[i, i] = pr_detect * 1 / 2.0 * (trans_pr_d + trans_pr_u) * self.bin_width  # Prob of not going anywhere         
+        x = self.mid_bins[None, :]  # True block lengths (columns)
+        y = self.mid_bins[:, None]  # Observed block lengths (rows)
+        pr_detect = (1 - censor_prob(x))  # Probability of detecting block
+        pr_down, d_rate, u_rate = prob_down(x), down_rate(x), up_rate(x)
+        norm_down = 1 - np.exp(-d_rate * (x - 1))  # Down probability conditional on bigger than cut off
+        
+        trans_pr_d = pr_down * d_rate * np.exp(-d_rate * np.maximum(x - y, 0)) / norm_down  # Only used for y<x
+        trans_pr_u = (1 - pr_down) * u_rate * np.exp(-u_rate * (y - np.maximum(x, 1)))  # Only used for y>x
+        trans_pr = np.where(y < x, trans_pr_d, trans_pr_u)
+        
+        # Now do the i,i case (both exponentials are one):
+        trans_pr_i = 1 / 2.0 * (pr_down * d_rate / norm_down + (1 - pr_down) * u_rate)  # Prob of not going anywhere
+        np.fill_diagonal(trans_pr, trans_pr_i)
+        self.trans_mat = pr_detect * trans_pr * self.bin_width
+        self.trans_mat_active = np.ascontiguousarray(self.trans_mat[self._shr_slice, :])  # Only rows used in likelihood
         
-    def calculate_full_bin_prob(self):
-        '''Calculate the full probablities per bin'''
+    def calculate_full_bin_prob(self, interest_only=False):
+        '''Calculate the full probablities per bin.
+        If interest_only only calculate them for the bins of interest'''
         # Transition matrix times theoretically expected + false positives.
         if self.error_model == True:
-            self.full_shr_pr = (np.dot(self.trans_mat, self.theoretical_shr) + self.fp_rate)  # Model with full error
+            if interest_only:
+                trans_mat, fp = self.trans_mat_active, self.fp_rate[self._shr_slice]
+            else:
+                trans_mat, fp = self.trans_mat, self.fp_rate
+            # If theoretical sharing is matrix (one row per pair) do all pairs in one matrix product:
+            shape = np.shape(self.theoretical_shr)[:-1] + (len(trans_mat),)
+            if self._full_shr_pr_buf.shape != shape:  # Reuse result array if shape is the same
+                self._full_shr_pr_buf = np.empty(shape)
+            self.full_shr_pr = np.dot(self.theoretical_shr, trans_mat.T, out=self._full_shr_pr_buf)
+            self.full_shr_pr += fp  # Model with full error
+        elif interest_only:
+            self.full_shr_pr = self.theoretical_shr[..., self._shr_slice]  # Model without any error in detection
         else:
             self.full_shr_pr = self.theoretical_shr  # Model without any error in detection
     
@@ -154,41 +201,41 @@ class MLE_estim_error(GenericLikelihoodModel):
         ind = bisect_right(bins, interval[0])
         ind1 = bisect_left(bins, interval[1])
         
-        estims = np.array([0.0 for i in r])
-        for i in range(len(r)):
-            self.calculate_thr_shr(r[i], params)  # Calculate the theoretical sharing
-            self.calculate_full_bin_prob()  # Calculate the bin probability of sharing a block                
-            # Do the numerical "Integral":
-            mean_value = np.mean([self.full_shr_pr[j] for j in range(ind - 1, ind1 + 1)])
-            estims[i] = mean_value * (interval[1] - interval[0]) / self.bin_width  # Normalize
+        r = np.asarray(r, dtype='float')
+        self.calculate_thr_shr(r[:, None], params)  # Calculate the theoretical sharing for all r at once
+        self.calculate_full_bin_prob()  # Calculate the bin probability of sharing a block (one row per r)
+        # Do the numerical "Integral":
+        mean_value = np.mean(self.full_shr_pr[:, ind - 1:ind1 + 1], axis=1)
+        estims = mean_value * (interval[1] - interval[0]) / self.bin_width  # Normalize
         return(estims) 
             
     def block_shr_density(self, l, r, params):
         '''Returns block sharing density per cM; if l vector return vector
+        If additionally r column vector return matrix (rows r, columns l)
         Uses self.density_fun as function'''
         return self.density_fun(l, r, params)
 
 ############# Functions the class uses for calculating errors. From Ralph/Coop 2013.      
 
 def censor_prob(l):
-    '''Probability of being unobserved given true length of x'''
+    '''Probability of being unobserved given true length of x. If l vector return vector'''
     return 1.0 / (1 + 0.0772355 * (l ** 2) * np.exp(0.5423082 * l))
         
 def prob_down(l):
-    '''Probability  the observed block is shorter than the true block'''
-    l1 = max((l - 1, 0))
+    '''Probability  the observed block is shorter than the true block. If l vector return vector'''
+    l1 = np.maximum(l - 1.0, 0.0)
     return (1 - 1 / (1.0 + 0.5066205 * l1 * np.exp(0.6761991 * l1))) * 0.341945
     
 def up_rate(l):
     '''parameter for (conditioned) exponential distr'n of observed-true 
-    length given true length of x if observed > true'''
+    length given true length of x if observed > true. Constant; broadcasts against l'''
     return 1.399283
     
 def down_rate(l):
     '''parameter for (conditioned) exponential distr'n of observed-true 
-    length given true length of x if observed < true
+    length given true length of x if observed < true. If l vector return vector
     '''
-    return np.min([12.0, (0.4009342 + 1.0 / (0.18161222 * l))])
+    return np.minimum(12.0, (0.4009342 + 1.0 / (0.18161222 * l)))
 
 def fp_rate(l):
     '''Gives the false positive rate per pair (!). If l vector return vector'''
@@ -200,22 +247,31 @@ def bessel_decay_dens(l, r, C, sigma, mu=0):
     l_e = l - mu / 2.0  # Update for population growth!
     l_e = l_e.clip(0.0)  # Update for very short block sizes 
     # l_e = max([l_e, 0]) 
-    b_l = C * r ** 2 / (2 * l_e / 100.0 * sigma ** 2) * kv(2, np.sqrt(2 * l_e / 100.0) * r / sigma)
-    return b_l / 100.0  # Factor in density for centi Morgan!
+    l_e = l_e / 100.0  # Switch to Morgan
+    z = r / sigma
+    x = np.sqrt(2 * l_e) * z  # Argument of the Bessel function
+    b_l = (C / 200.0 * z ** 2) * (1 / l_e) * kve(2, x) * np.exp(-x)  # Factor 100 in density for centi Morgan!
+    return b_l
 
 def dd_density(l, r, params):
     '''Gives the Doomsday density per cM(!) If l vector return vector'''
     C = params[0]
     sigma = params[1]
-    b_l = C * r ** 3 / (4.0 * np.sqrt(2) * (l / 100.0 * sigma ** 2) ** (3 / 2.0)) * kv(3, np.sqrt(2.0 * l / 100.0) * r / sigma)
-    return b_l / 100.0  # Factor for density in centi Morgan
+    l = l / 100.0  # Switch to Morgan
+    z = r / sigma
+    x = np.sqrt(2.0 * l) * z  # Argument of the Bessel function
+    b_l = (C / (400.0 * np.sqrt(2)) * z ** 3) * l ** (-3 / 2.0) * kve(3, x) * np.exp(-x)  # Factor 100 for density in centi Morgan
+    return b_l
 
 def uniform_density(l, r, params):
     '''Gives density per cM(!) for constant population size. If l vector return vector'''
     C = params[0]
     sigma = params[1]
-    b_l = C * r ** 2 / (2.0 * (l / 100.0 * sigma ** 2)) * kv(2, np.sqrt(2.0 * l / 100.0) * r / sigma)
-    return b_l / 100.0  # Factor for density in centi Morgan  
+    l = l / 100.0  # Switch to Morgan
+    z = r / sigma
+    x = np.sqrt(2.0 * l) * z  # Argument of the Bessel function
+    b_l = (C / 200.0 * z ** 2) * (1 / l) * kve(2, x) * np.exp(-x)  # Factor 100 for density in centi Morgan
+    return b_l
 
 
 